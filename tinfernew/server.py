@@ -1,24 +1,39 @@
 import os
 import uuid
+import asyncio
 import logging
+import logging.handlers
+import queue
 import httpx
 import time
 import hashlib
-import random
-import string
-from fastapi import FastAPI, Request, Response, HTTPException
-from pydantic import BaseModel
+import hmac
+import secrets
+import tempfile
+from collections import defaultdict
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import msgspec
+from fastapi import FastAPI, Query, Request, Response, HTTPException
+from fastapi.responses import JSONResponse
+from starlette.routing import Route
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackContext
-from urllib.parse import urlencode
-import qrcode
+from telegram.ext import AIORateLimiter, Application, CommandHandler, CallbackContext
+import segno
 from io import BytesIO
 
 # --- Basic Setup ---
+# Log records are put on a queue and written to stderr by a background thread,
+# so logging calls on the event loop never block on the stream's lock or I/O.
+# The QueueHandler formats each record, the listener's handler just writes it.
+LOG_QUEUE = queue.SimpleQueue()
+LOG_LISTENER = logging.handlers.QueueListener(LOG_QUEUE, logging.StreamHandler())
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.handlers.QueueHandler(LOG_QUEUE)]
 )
+LOG_LISTENER.start()
 logger = logging.getLogger(__name__)
 
 # --- Load configuration from environment variables ---
@@ -30,45 +45,186 @@ PUBLIC_SERVER_URL = os.environ.get("PUBLIC_SERVER_URL")
 if not PUBLIC_SERVER_URL:
     raise ValueError("Error: PUBLIC_SERVER_URL environment variable must be set")
 
+# Secret Telegram echoes back in the X-Telegram-Bot-Api-Secret-Token header.
+# Defaults to a value derived from the bot token so no extra setup is needed.
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode('utf-8')).hexdigest()
+
+# HTTP version for Bot API calls. HTTP/2 is opt-in: python-telegram-bot went
+# back to 1.1 as its default because h2 can cancel keep-alive connections
+# (h2#1181, python-telegram-bot#3556), which breaks sends under load.
+TELEGRAM_HTTP_VERSION = os.environ.get("TELEGRAM_HTTP_VERSION", "1.1")
+if TELEGRAM_HTTP_VERSION not in ("1.1", "2"):
+    raise ValueError(f"Error: TELEGRAM_HTTP_VERSION must be '1.1' or '2', got {TELEGRAM_HTTP_VERSION}")
+
 # --- GlobePay Configuration ---
 GLOBEPAY_PARTNER_CODE = os.environ.get("GLOBEPAY_PARTNER_CODE")
 GLOBEPAY_CREDENTIAL = os.environ.get("GLOBEPAY_CREDENTIAL")
-PRICE_AMOUNT = os.environ.get("PRICE_AMOUNT", "0.99") 
-PRICE_CURRENCY = os.environ.get("PRICE_CURRENCY", "CNY")
+PRICE_AMOUNT: str = os.environ.get("PRICE_AMOUNT", "0.99")
+PRICE_CURRENCY: str = os.environ.get("PRICE_CURRENCY", "CNY")
 
 if not GLOBEPAY_PARTNER_CODE or not GLOBEPAY_CREDENTIAL:
     raise ValueError("Error: GLOBEPAY_PARTNER_CODE and GLOBEPAY_CREDENTIAL must be set")
 
-# --- In-memory job storage ---
-JOBS = {}
+try:
+    # Convert price from decimal string (e.g., "0.99") to integer in cents (e.g., 99).
+    # Decimal avoids float truncation: int(float("0.29") * 100) is 28.
+    PRICE_IN_SMALLEST_UNIT: int = int((Decimal(PRICE_AMOUNT) * 100).to_integral_value(rounding=ROUND_HALF_UP))
+except (InvalidOperation, ValueError, OverflowError):
+    raise ValueError(f"Error: Invalid PRICE_AMOUNT format: {PRICE_AMOUNT}. It should be a number string like '0.99'")
+if PRICE_IN_SMALLEST_UNIT <= 0:
+    raise ValueError(f"Error: PRICE_AMOUNT must be at least 0.01, got {PRICE_AMOUNT}")
+# The amount shown to users, derived from what is actually charged.
+PRICE_DISPLAY: str = f"{Decimal(PRICE_IN_SMALLEST_UNIT) / 100:.2f}"
+
+GLOBEPAY_ORDERS_URL = f"https://pay.globepay.co/api/v1.0/gateway/partners/{GLOBEPAY_PARTNER_CODE}/orders"
+GLOBEPAY_NOTIFY_URL = f"{PUBLIC_SERVER_URL}/api/payment-notify"
+# The string to sign always starts with "partner_code&" and ends with
+# "&credential": hash the head once and encode the tail once.
+GLOBEPAY_SIGN_PREFIX = hashlib.sha256(f"{GLOBEPAY_PARTNER_CODE}&".encode('utf-8'))
+GLOBEPAY_SIGN_SUFFIX = f"&{GLOBEPAY_CREDENTIAL}".encode('utf-8')
 
-# --- Pydantic model defines the API's data structure ---
-class TaskUpdateRequest(BaseModel):
+# --- In-memory job storage ---
+# JOBS and the queues below live in this process only, so the app must run
+# as a single uvicorn worker (see the Dockerfile); a second worker would see
+# its own, different job table.
+@dataclass(slots=True)
+class Job:
+    prompt: str
+    chat_id: int
+    status: str
+    # Wall-clock time (time.time()) so it stays meaningful across restarts.
+    created_at: float = field(default_factory=time.time)
+    # When the job was last handed to a Worker (time.time()), or None.
+    started_at: float | None = None
+
+JOBS: dict[str, Job] = {}
+# Job IDs grouped by status, so sweeps only look at the jobs they care about.
+# Kept in sync by add_job / set_job_status / drop_job; don't write job.status directly.
+JOBS_BY_STATUS: defaultdict[str, set[str]] = defaultdict(set)
+# Job IDs that have been paid for and are waiting for a Worker, in FIFO order.
+PENDING_QUEUE: asyncio.Queue[str] = asyncio.Queue()
+# Upper bound for how long a Worker may long-poll /api/get-task.
+MAX_TASK_WAIT_SECONDS = 60
+# Upper bound for how many tasks a Worker may take in one /api/get-task call.
+MAX_TASKS_PER_REQUEST = 20
+# Poll interval hints (in ms) for Workers that found no task: short while jobs
+# have been queued recently, longer once the queue has been quiet for a while.
+BUSY_RETRY_AFTER_MS = 250
+IDLE_RETRY_AFTER_MS = 5000
+QUEUE_IDLE_SECONDS = 60
+# time.monotonic() of the last time a job was put on PENDING_QUEUE.
+LAST_JOB_QUEUED_AT = float("-inf")
+# How long COMPLETED/FAILED jobs are kept before being dropped from JOBS.
+JOB_RETENTION_SECONDS = 300
+# Orders that are still unpaid after this long are dropped from JOBS. Generous,
+# because a payment notice for a dropped order can no longer be matched.
+UNPAID_JOB_RETENTION_SECONDS = 24 * 60 * 60
+# A RUNNING job whose Worker has not reported back after this long is assumed
+# lost (crashed Worker) and is queued again. Worker-side Textoon runs time out
+# after 10 minutes; this leaves room for zipping and uploading on top of that.
+MAX_RUNNING_SECONDS = 30 * 60
+JOB_REAP_INTERVAL_SECONDS = 300
+# Unfinished jobs are saved here on shutdown and restored on startup.
+# ./output is mounted as a volume in docker-compose, so it survives restarts.
+JOBS_STATE_PATH = os.environ.get("JOBS_STATE_PATH", os.path.join("output", "jobs.json"))
+# Unfinished jobs are also saved this often, so a crash loses at most one interval.
+JOBS_CHECKPOINT_SECONDS = 30
+# The checkpoint write currently (or last) running in a thread. Cancelling the
+# checkpoint task does not stop that thread, so shutdown waits for it before
+# the final save; otherwise its older snapshot could replace the final one.
+CHECKPOINT_WRITE: asyncio.Future | None = None
+
+# --- Per-chat update queues ---
+# Updates for one chat are processed in order, while different chats are
+# processed concurrently. Each queue is drained by its own task, which exits
+# (and drops the queue) after the chat has been idle for a while.
+CHAT_QUEUES: dict[int | None, asyncio.Queue] = {}
+CHAT_QUEUE_IDLE_SECONDS = 60
+# Caps how many updates (across all chats) are processed at the same time.
+UPDATE_SEMAPHORE = asyncio.Semaphore(256)
+
+# --- Coalesced status notifications ---
+# Status notices for the same chat that arrive within this window are joined
+# and sent as a single message.
+NOTIFICATION_DELAY_SECONDS = 0.5
+# A buffer that would grow past either limit is sent right away instead
+# (Telegram rejects messages longer than 4096 characters).
+MAX_NOTIFICATIONS_PER_MESSAGE = 10
+MAX_NOTIFICATION_LENGTH = 4096
+PENDING_NOTIFICATIONS: dict[int, list[str]] = {}
+
+# Strong references to fire-and-forget tasks so they are not garbage collected.
+# BACKGROUND_TASKS (update drains, checkpointing, reaping) are cancelled on
+# shutdown; SEND_TASKS (outgoing Telegram messages) are given time to finish.
+BACKGROUND_TASKS: set[asyncio.Task] = set()
+SEND_TASKS: set[asyncio.Task] = set()
+SHUTDOWN_SEND_TIMEOUT_SECONDS = 10
+
+# --- Shared HTTP client (created on startup, closed on shutdown) ---
+HTTPX_CLIENT: httpx.AsyncClient | None = None
+
+# --- msgspec struct defines the API's data structure ---
+class TaskUpdateRequest(msgspec.Struct):
     job_id: str
     status: str
     result_url: str | None = None
 
+class Task(msgspec.Struct):
+    job_id: str
+    prompt: str
+    chat_id: int
+
+class NoTaskResponse(msgspec.Struct):
+    """Single-task reply when nothing is pending; keeps the null fields old Workers check."""
+    job_id: None
+    prompt: None
+    chat_id: None
+    retry_after_ms: int
+
+class TaskBatchResponse(msgspec.Struct, omit_defaults=True):
+    tasks: list[Task]
+    retry_after_ms: int | None = None
+
+# --- JSON responses encoded with msgspec instead of the stdlib json module ---
+class MsgspecJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return msgspec.json.encode(content)
+
 # --- FastAPI application instance ---
-app = FastAPI()
+app = FastAPI(default_response_class=MsgspecJSONResponse)
 
 # --- Telegram Bot Setup ---
-telegram_app = Application.builder().token(BOT_TOKEN).build()
+# The rate limiter keeps all outgoing Bot API calls under Telegram's flood
+# limits and retries requests that are still answered with 429 RetryAfter.
+telegram_app = (
+    Application.builder()
+    .token(BOT_TOKEN)
+    .http_version(TELEGRAM_HTTP_VERSION)
+    .rate_limiter(AIORateLimiter(max_retries=3))
+    .build()
+)
+# The builder creates the bot up front and it never changes, so look it up once.
+BOT = telegram_app.bot
 
 # --- GlobePay Helper Functions (Rewritten according to the correct documentation) ---
-def generate_globepay_signature(partner_code: str, timestamp: str, nonce: str, credential: str) -> str:
+def generate_globepay_signature(timestamp: str, nonce: str) -> str:
     """
     Generates a SHA256 signature based on the correct documentation.
-    The string to sign is much simpler.
+    The string to sign is "partner_code&time&nonce_str&credential"; only the
+    time and nonce part is hashed per call, on a copy of the prehashed head.
     """
-    valid_string = f"{partner_code}&{timestamp}&{nonce}&{credential}"
-    logger.info(f"String to be signed (SHA256): {valid_string}")
+    variable_part = f"{timestamp}&{nonce}"
+    logger.debug("String to be signed (SHA256, partner code and credential omitted): %s", variable_part)
     
-    # Use SHA256 and lowercase hex string as required.
-    return hashlib.sha256(valid_string.encode('utf-8')).hexdigest().lower()
+    # Use SHA256 and lowercase hex string as required (hexdigest is already lowercase).
+    digest = GLOBEPAY_SIGN_PREFIX.copy()
+    digest.update(variable_part.encode('utf-8'))
+    digest.update(GLOBEPAY_SIGN_SUFFIX)
+    return digest.hexdigest()
 
 def generate_nonce_str() -> str:
-    """Generates a random string for the nonce."""
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=16))
+    """Generates a random 16-character hex string for the nonce."""
+    return secrets.token_hex(8)
 
 async def create_payment_qr(job_id: str) -> str | None:
     """
@@ -78,72 +234,105 @@ async def create_payment_qr(job_id: str) -> str | None:
     nonce = generate_nonce_str()
     
     # Generate the signature using the new, correct method.
-    sign = generate_globepay_signature(GLOBEPAY_PARTNER_CODE, timestamp, nonce, GLOBEPAY_CREDENTIAL)
+    sign = generate_globepay_signature(timestamp, nonce)
     
     # Build the full URL with query parameters.
-    api_url = (
-        f"https://pay.globepay.co/api/v1.0/gateway/partners/{GLOBEPAY_PARTNER_CODE}/orders/{job_id}"
-        f"?time={timestamp}&nonce_str={nonce}&sign={sign}"
-    )
+    api_url = f"{GLOBEPAY_ORDERS_URL}/{job_id}?time={timestamp}&nonce_str={nonce}&sign={sign}"
     
-    try:
-        # Convert price from float string (e.g., "0.99") to integer in cents (e.g., 99).
-        price_in_smallest_unit = int(float(PRICE_AMOUNT) * 100)
-    except ValueError:
-        logger.error(f"Invalid PRICE_AMOUNT format: {PRICE_AMOUNT}. It should be a number string like '0.99'.")
-        return None
-
     # Prepare the JSON body for the PUT request.
     json_body = {
         "description": "AI Drawing Task",
-        "price": price_in_smallest_unit, # Send as integer
+        "price": PRICE_IN_SMALLEST_UNIT, # Send as integer
         "currency": PRICE_CURRENCY,
         "channel": "Alipay", # Or "Wechat"
-        "notify_url": f"{PUBLIC_SERVER_URL}/api/payment-notify"
+        "notify_url": GLOBEPAY_NOTIFY_URL
     }
     
     try:
-        async with httpx.AsyncClient() as client:
-            # Use PUT method with JSON body as required.
-            response = await client.put(api_url, json=json_body, timeout=30)
-            
-            data = response.json()
-            
-            logger.info(f"GlobePay API Response for job {job_id}: STATUS={response.status_code}, BODY={data}")
+        # Use PUT method with JSON body as required.
+        # The shared client keeps the connection to GlobePay alive between orders.
+        response = await HTTPX_CLIENT.put(api_url, json=json_body)
+        
+        data = response.json()
+        
+        logger.info("GlobePay API Response for job %s: STATUS=%s, BODY=%s", job_id, response.status_code, data)
 
-            response.raise_for_status()
-            
-            if data.get("result_code") == "SUCCESS":
-                return data.get("code_url")
-            else:
-                logger.error(f"GlobePay returned a non-SUCCESS result_code for job {job_id}: {data.get('return_msg')}")
-                return None
+        response.raise_for_status()
+        
+        if data.get("result_code") == "SUCCESS":
+            return data.get("code_url")
+        else:
+            logger.error("GlobePay returned a non-SUCCESS result_code for job %s: %s", job_id, data.get('return_msg'))
+            return None
     except httpx.HTTPStatusError as e:
-        logger.error(f"HTTP Error calling GlobePay API for job {job_id}: {e.response.text}")
+        logger.error("HTTP Error calling GlobePay API for job %s: %s", job_id, e.response.text)
         return None
     except Exception as e:
-        logger.error(f"Unknown Error calling GlobePay API for job {job_id}: {e}", exc_info=True)
+        logger.error("Unknown Error calling GlobePay API for job %s: %s", job_id, e, exc_info=True)
         return None
 
 # --- Telegram Helper Functions ---
 async def send_telegram_message(chat_id: int, text: str, reply_markup=None):
     """A helper function to send a message to a specified Telegram user."""
     try:
-        await telegram_app.bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown', reply_markup=reply_markup)
+        await BOT.send_message(chat_id=chat_id, text=text, parse_mode='Markdown', reply_markup=reply_markup)
     except Exception as e:
-        logger.error(f"Error sending message to chat_id {chat_id}: {e}")
+        logger.error("Error sending message to chat_id %s: %s", chat_id, e)
+
+def render_qr_png(qr_data: str) -> bytes:
+    """Renders a QR code as PNG bytes. CPU-bound; run it off the event loop."""
+    # segno writes the PNG itself, without going through PIL.
+    qr = segno.make_qr(qr_data, error='m')
+    bio = BytesIO()
+    qr.save(bio, kind='png', scale=10)
+    return bio.getvalue()
 
 async def send_qr_code_image(chat_id: int, qr_data: str, caption: str):
     """Generates and sends a QR code image."""
     try:
-        img = qrcode.make(qr_data)
-        bio = BytesIO()
-        bio.name = 'payment_qr.png'
-        img.save(bio, 'PNG')
-        bio.seek(0)
-        await telegram_app.bot.send_photo(chat_id=chat_id, photo=bio, caption=caption)
+        png_bytes = await asyncio.to_thread(render_qr_png, qr_data)
+        await BOT.send_photo(chat_id=chat_id, photo=png_bytes, caption=caption, filename='payment_qr.png')
     except Exception as e:
-        logger.error(f"Error sending QR code to chat_id {chat_id}: {e}")
+        logger.error("Error sending QR code to chat_id %s: %s", chat_id, e)
+
+def queue_notification(chat_id: int, text: str):
+    """Buffers a status notice; the chat's buffer is sent shortly after its first notice, or once full."""
+    lines = PENDING_NOTIFICATIONS.get(chat_id)
+    if lines is not None and (
+        len(lines) >= MAX_NOTIFICATIONS_PER_MESSAGE
+        or sum(map(len, lines)) + 2 * len(lines) + len(text) > MAX_NOTIFICATION_LENGTH
+    ):
+        flush_notifications(chat_id)
+        lines = None
+    if lines is None:
+        PENDING_NOTIFICATIONS[chat_id] = [text]
+        asyncio.get_running_loop().call_later(NOTIFICATION_DELAY_SECONDS, flush_notifications, chat_id)
+    else:
+        lines.append(text)
+
+def flush_notifications(chat_id: int):
+    """Sends all buffered notices for a chat as one message."""
+    lines = PENDING_NOTIFICATIONS.pop(chat_id, None)
+    if lines:
+        spawn_send_task(send_telegram_message(chat_id, "\n\n".join(lines)))
+
+# --- Job Table Helpers ---
+def add_job(job_id: str, job: Job):
+    """Inserts a job into JOBS and its status bucket."""
+    JOBS[job_id] = job
+    JOBS_BY_STATUS[job.status].add(job_id)
+
+def set_job_status(job_id: str, job: Job, status: str):
+    """Changes a job's status and moves it to the matching JOBS_BY_STATUS bucket."""
+    JOBS_BY_STATUS[job.status].discard(job_id)
+    job.status = status
+    JOBS_BY_STATUS[status].add(job_id)
+
+def drop_job(job_id: str):
+    """Removes a job from JOBS and its status bucket, if it is still there."""
+    job = JOBS.pop(job_id, None)
+    if job is not None:
+        JOBS_BY_STATUS[job.status].discard(job_id)
 
 # --- Telegram Command Handlers ---
 async def start_command(update: Update, context: CallbackContext):
@@ -174,7 +363,7 @@ async def vtuber_command(update: Update, context: CallbackContext):
         await update.message.reply_text("Please provide a description. For example: `/vtuber a girl wearing a cat-ear hat`")
         return
 
-    job_id = str(uuid.uuid4()).replace('-', '')
+    job_id = uuid.uuid4().hex
     chat_id = update.effective_chat.id
     
     await update.message.reply_text("Creating your payment order, please wait...")
@@ -182,21 +371,17 @@ async def vtuber_command(update: Update, context: CallbackContext):
     qr_code_url = await create_payment_qr(job_id)
 
     if qr_code_url:
-        JOBS[job_id] = {
-            "prompt": prompt,
-            "chat_id": chat_id,
-            "status": "AWAITING_PAYMENT"
-        }
+        add_job(job_id, Job(prompt=prompt, chat_id=chat_id, status="AWAITING_PAYMENT"))
         
         payment_caption = (
             f"✅ Your order has been created! Please scan the QR code below to complete the payment.\n\n"
-            f"💰 **Amount: {PRICE_AMOUNT} {PRICE_CURRENCY}**\n"
+            f"💰 **Amount: {PRICE_DISPLAY} {PRICE_CURRENCY}**\n"
             f"📝 **Your Task:** {prompt}\n"
             f"🆔 **Order ID:** `{job_id}`\n\n"
             f"Once payment is successful, your task will automatically be queued for processing."
         )
         await send_qr_code_image(chat_id, qr_code_url, payment_caption)
-        logger.info(f"Payment order created for job {job_id} for chat_id {chat_id}")
+        logger.info("Payment order created for job %s for chat_id %s", job_id, chat_id)
     else:
         await send_telegram_message(chat_id, "❌ Sorry, we failed to create a payment order. Please try again later or contact an administrator.")
 
@@ -215,24 +400,142 @@ telegram_app.add_handler(CommandHandler("help", help_command))
 telegram_app.add_handler(CommandHandler("vtuber", vtuber_command))
 telegram_app.add_handler(CommandHandler("dmiu", dmiu_command))
 
-# --- FastAPI Webhook Endpoint ---
-@app.post(f"/{BOT_TOKEN}")
-async def telegram_webhook(request: Request):
-    """This endpoint receives updates from Telegram"""
-    update_data = await request.json()
-    update = Update.de_json(update_data, telegram_app.bot)
-    await telegram_app.process_update(update)
-    return Response(status_code=200)
+# Fast path for plain command messages; anything else still goes through process_update.
+COMMAND_HANDLERS = {
+    "start": start_command,
+    "help": help_command,
+    "vtuber": vtuber_command,
+    "dmiu": dmiu_command,
+}
+
+# --- Update Dispatch ---
+def spawn_background_task(coro) -> asyncio.Task:
+    """Schedules a coroutine and keeps a reference to it until it finishes."""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+def spawn_send_task(coro) -> asyncio.Task:
+    """Schedules a Telegram send that shutdown waits for instead of cancelling."""
+    task = asyncio.create_task(coro)
+    SEND_TASKS.add(task)
+    task.add_done_callback(SEND_TASKS.discard)
+    return task
+
+async def drain_chat_queue(chat_id: int | None, queue: asyncio.Queue):
+    """Builds and processes the updates of a single chat one after another."""
+    while True:
+        try:
+            update_data = await asyncio.wait_for(queue.get(), timeout=CHAT_QUEUE_IDLE_SECONDS)
+        except asyncio.TimeoutError:
+            if queue.empty():
+                del CHAT_QUEUES[chat_id]
+                return
+            continue
+
+        try:
+            async with UPDATE_SEMAPHORE:
+                update = Update.de_json(update_data, BOT)
+                if not await route_command(update):
+                    await telegram_app.process_update(update)
+        except Exception as e:
+            logger.error("Error processing update %s for chat_id %s: %s", update_data.get("update_id"), chat_id, e, exc_info=True)
+
+async def route_command(update: Update) -> bool:
+    """Calls the handler for a /command message directly. Returns False if the update isn't one."""
+    message = update.message
+    if message is None or not message.text or not message.text.startswith("/"):
+        return False
+    words = message.text.split()
+    command, _, bot_username = words[0][1:].partition("@")
+    if bot_username and bot_username.lower() != BOT.username.lower():
+        return False
+    handler = COMMAND_HANDLERS.get(command.lower())
+    if handler is None:
+        return False
+    context = CallbackContext.from_update(update, telegram_app)
+    context.args = words[1:]
+    await handler(update, context)
+    return True
+
+def update_chat_id(update_data: dict) -> int | None:
+    """Finds the chat a raw update belongs to without building the Update object."""
+    for key, value in update_data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        return chat.get("id") if chat else None
+    return None
+
+def dispatch_update(update_data: dict):
+    """Puts a raw update on its chat's queue, starting a drain task if needed."""
+    chat_id = update_chat_id(update_data)
+    queue = CHAT_QUEUES.get(chat_id)
+    if queue is None:
+        queue = CHAT_QUEUES[chat_id] = asyncio.Queue()
+        spawn_background_task(drain_chat_queue(chat_id, queue))
+    queue.put_nowait(update_data)
+
+# --- Telegram Webhook Endpoint (bare ASGI) ---
+WEBHOOK_PATH = "/tg/webhook"
+WEBHOOK_SECRET_HEADER = b"x-telegram-bot-api-secret-token"
+WEBHOOK_SECRET_BYTES = WEBHOOK_SECRET.encode('utf-8')
+WEBHOOK_ACK_START = {
+    "type": "http.response.start",
+    "status": 200,
+    "headers": [(b"content-length", b"0")],
+}
+WEBHOOK_FORBIDDEN_START = {
+    "type": "http.response.start",
+    "status": 403,
+    "headers": [(b"content-length", b"0")],
+}
+WEBHOOK_ACK_BODY = {"type": "http.response.body", "body": b""}
+
+class TelegramWebhook:
+    """
+    This endpoint receives updates from Telegram.
+    It is a plain ASGI app so the hottest route skips FastAPI's request,
+    dependency and response handling entirely.
+    """
+    async def __call__(self, scope, receive, send):
+        received_secret = b""
+        for name, value in scope["headers"]:
+            if name == WEBHOOK_SECRET_HEADER:
+                received_secret = value
+                break
+        if not hmac.compare_digest(received_secret, WEBHOOK_SECRET_BYTES):
+            logger.warning("Rejected webhook request with a missing or invalid secret token.")
+            await send(WEBHOOK_FORBIDDEN_START)
+            await send(WEBHOOK_ACK_BODY)
+            return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        # Queue the raw update for its chat and acknowledge right away;
+        # Telegram retries deliveries that are not answered quickly enough.
+        # Building the Update object is left to the chat's drain task.
+        dispatch_update(msgspec.json.decode(body))
+        await send(WEBHOOK_ACK_START)
+        await send(WEBHOOK_ACK_BODY)
+
+# Insert ahead of the FastAPI routes so it is the first one matched.
+app.router.routes.insert(0, Route(WEBHOOK_PATH, TelegramWebhook(), methods=["POST"]))
 
 # --- API Endpoint for GlobePay Payment Notifications ---
 @app.post("/api/payment-notify")
 async def payment_notify(request: Request):
     """This endpoint receives payment success notifications from GlobePay."""
-    # This part remains tricky as the notification signature is not well-documented.
-    # We will assume a simple structure for now.
+    global LAST_JOB_QUEUED_AT
     try:
-        data = await request.json()
-        logger.info(f"Received GlobePay notification: {data}")
+        data = msgspec.json.decode(await request.body())
+        logger.info("Received GlobePay notification: %s", data)
 
         # The order ID from the notification is likely in 'partner_order_id'
         order_id = data.get('partner_order_id')
@@ -240,75 +543,287 @@ async def payment_notify(request: Request):
             logger.warning("Notification received without a partner_order_id. Ignoring.")
             return {"result": "success"}
 
+        # Notifications are signed like our API requests: sha256 over
+        # "partner_code&time&nonce_str&credential", compared in constant time.
+        expected_sign = generate_globepay_signature(str(data.get('time', '')), str(data.get('nonce_str', '')))
+        # Our digest is lowercase hex; accept either case from GlobePay.
+        received_sign = str(data.get('sign', '')).lower()
+        if not hmac.compare_digest(expected_sign.encode('utf-8'), received_sign.encode('utf-8')):
+            logger.warning("Rejected GlobePay notification with an invalid signature for job: %s", order_id)
+            raise HTTPException(status_code=400, detail="Invalid signature")
+
         job = JOBS.get(order_id)
         if not job:
-            logger.error(f"Received notification for a non-existent job: {order_id}")
+            logger.error("Received notification for a non-existent job: %s", order_id)
             return {"result": "success"}
 
-        if job["status"] == "AWAITING_PAYMENT":
-            job["status"] = "PENDING"
-            logger.info(f"Payment successful for job {order_id}. Status updated to PENDING.")
+        if job.status == "AWAITING_PAYMENT":
+            set_job_status(order_id, job, "PENDING")
+            PENDING_QUEUE.put_nowait(order_id)
+            LAST_JOB_QUEUED_AT = time.monotonic()
+            logger.info("Payment successful for job %s. Status updated to PENDING.", order_id)
             
-            await send_telegram_message(
-                job["chat_id"],
+            # Don't hold GlobePay's callback open for the Telegram round-trip.
+            spawn_send_task(send_telegram_message(
+                job.chat_id,
                 f"🎉 Payment successful!\n\nYour task `{order_id}` is now in the queue to be processed."
-            )
+            ))
         else:
-            logger.warning(f"Received duplicate notification for job: {order_id}, current status: {job['status']}")
+            logger.warning("Received duplicate notification for job: %s, current status: %s", order_id, job.status)
 
         return {"result": "success"}
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error processing GlobePay notification: {e}")
+        logger.error("Error processing GlobePay notification: %s", e)
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 # --- API Endpoint for Workers ---
+async def next_pending_job(timeout: float) -> str | None:
+    """
+    Pops the next job that is still PENDING, waiting up to `timeout` seconds
+    for one to be paid for. Returns None if none became available in time.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        if not PENDING_QUEUE.empty():
+            job_id = PENDING_QUEUE.get_nowait()
+        else:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                job_id = await asyncio.wait_for(PENDING_QUEUE.get(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return None
+
+        job = JOBS.get(job_id)
+        # Skip entries whose job was evicted or already moved on.
+        if job and job.status == "PENDING":
+            return job_id
+
+def retry_after_ms() -> int:
+    """Suggests how long a Worker that got no task should wait before polling again."""
+    if time.monotonic() - LAST_JOB_QUEUED_AT > QUEUE_IDLE_SECONDS:
+        return IDLE_RETRY_AFTER_MS
+    return BUSY_RETRY_AFTER_MS
+
+def assign_job(job_id: str) -> Task:
+    """Marks a pending job as RUNNING and returns the task payload for a Worker."""
+    job = JOBS[job_id]
+    set_job_status(job_id, job, "RUNNING")
+    job.started_at = time.time()
+    logger.info("Task assigned to Worker: %s", job_id)
+    return Task(job_id=job_id, prompt=job.prompt, chat_id=job.chat_id)
+
 @app.get("/api/get-task")
-async def get_task():
-    """Called by the local Worker to get a pending task"""
-    for job_id, task_details in JOBS.items():
-        if task_details["status"] == "PENDING":
-            task_details["status"] = "RUNNING"
-            logger.info(f"Task assigned to Worker: {job_id}")
-            return {
-                "job_id": job_id,
-                "prompt": task_details["prompt"],
-                "chat_id": task_details["chat_id"]
-            }
-    return {"job_id": None, "prompt": None, "chat_id": None}
+async def get_task(
+    wait: float = Query(0, ge=0, le=MAX_TASK_WAIT_SECONDS),
+    n: int | None = Query(None, ge=1, le=MAX_TASKS_PER_REQUEST)
+):
+    """
+    Called by the local Worker to get a pending task.
+    With `wait` > 0 the request is held open for up to that many seconds
+    until a task arrives (long polling); the default answers immediately.
+    With `n`, up to n tasks are returned at once as {"tasks": [...]}.
+    Empty responses carry a `retry_after_ms` polling hint.
+    Responses are msgspec structs returned as ready-made responses, which
+    skips FastAPI's jsonable_encoder pass on this hot path.
+    """
+    job_id = await next_pending_job(wait)
+
+    if n is None:
+        if job_id is None:
+            return MsgspecJSONResponse(NoTaskResponse(None, None, None, retry_after_ms()))
+        return MsgspecJSONResponse(assign_job(job_id))
+
+    if job_id is None:
+        return MsgspecJSONResponse(TaskBatchResponse([], retry_after_ms()))
+
+    tasks = []
+    while job_id is not None:
+        tasks.append(assign_job(job_id))
+        if len(tasks) == n:
+            break
+        job_id = await next_pending_job(0)
+    return MsgspecJSONResponse(TaskBatchResponse(tasks))
 
 @app.post("/api/update-task")
-async def update_task(update_request: TaskUpdateRequest):
+async def update_task(request: Request):
     """Called by the local Worker to update a task's status"""
+    try:
+        update_request = msgspec.json.decode(await request.body(), type=TaskUpdateRequest)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
     job = JOBS.get(update_request.job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Task not found")
     
-    job["status"] = update_request.status
-    logger.info(f"Task status updated: {update_request.job_id} -> {update_request.status}")
+    set_job_status(update_request.job_id, job, update_request.status)
+    logger.info("Task status updated: %s -> %s", update_request.job_id, update_request.status)
+
+    if update_request.status in ("COMPLETED", "FAILED"):
+        asyncio.get_running_loop().call_later(JOB_RETENTION_SECONDS, drop_job, update_request.job_id)
 
     if update_request.status == "COMPLETED":
-        await send_telegram_message(job["chat_id"], f"🎉 Your task `{update_request.job_id}` is complete! The file has been sent to you directly by the bot.")
+        if update_request.result_url:
+            # The Worker could not upload the file to Telegram and is hosting it instead.
+            queue_notification(job.chat_id, f"🎉 Your task `{update_request.job_id}` is complete! Download your file here: {update_request.result_url}")
+        else:
+            queue_notification(job.chat_id, f"🎉 Your task `{update_request.job_id}` is complete! The file has been sent to you directly by the bot.")
     elif update_request.status == "FAILED":
-        await send_telegram_message(job["chat_id"], f"Sorry, your task `{update_request.job_id}` has failed.")
+        queue_notification(job.chat_id, f"Sorry, your task `{update_request.job_id}` has failed.")
     
     return {"message": "Task status updated"}
 
+# Serialized once; health probes get the same bytes every time.
+HEALTH_CHECK_RESPONSE = Response(
+    content=b'{"status":"ok","service":"Telebot Dispatch Center with Payment"}',
+    media_type="application/json"
+)
+
 @app.get("/")
-def health_check():
+async def health_check():
     """Root path for health checks"""
-    return {"status": "ok", "service": "Telebot Dispatch Center with Payment"}
+    return HEALTH_CHECK_RESPONSE
+
+# --- Job Persistence ---
+def snapshot_jobs() -> bytes:
+    """Encodes the unfinished jobs as JSON. Must run on the event loop, which owns JOBS."""
+    unfinished = {job_id: job for job_id, job in JOBS.items() if job.status not in ("COMPLETED", "FAILED")}
+    return msgspec.json.encode(unfinished)
+
+def write_jobs_snapshot(snapshot: bytes):
+    """Atomically replaces JOBS_STATE_PATH with the given snapshot."""
+    state_dir = os.path.dirname(JOBS_STATE_PATH) or "."
+    os.makedirs(state_dir, exist_ok=True)
+    # A unique temp file per write, so a checkpoint still running in its
+    # thread cannot interleave with the final save on shutdown.
+    fd, tmp_path = tempfile.mkstemp(dir=state_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(snapshot)
+        os.replace(tmp_path, JOBS_STATE_PATH)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def save_jobs():
+    """Writes unfinished jobs to JOBS_STATE_PATH so a restart does not lose paid orders."""
+    write_jobs_snapshot(snapshot_jobs())
+    logger.info("Saved unfinished jobs to %s", JOBS_STATE_PATH)
+
+async def checkpoint_jobs():
+    """Saves unfinished jobs every JOBS_CHECKPOINT_SECONDS, writing the file in a thread."""
+    global CHECKPOINT_WRITE
+    while True:
+        await asyncio.sleep(JOBS_CHECKPOINT_SECONDS)
+        CHECKPOINT_WRITE = asyncio.get_running_loop().run_in_executor(None, write_jobs_snapshot, snapshot_jobs())
+        try:
+            # Shielded so cancelling this task leaves the future for shutdown to await.
+            await asyncio.shield(CHECKPOINT_WRITE)
+        except OSError as e:
+            logger.error("Could not checkpoint jobs to %s: %s", JOBS_STATE_PATH, e)
+
+async def reap_jobs():
+    """
+    Every JOB_REAP_INTERVAL_SECONDS, drops abandoned AWAITING_PAYMENT jobs and
+    re-queues RUNNING jobs whose Worker never reported back.
+    """
+    global LAST_JOB_QUEUED_AT
+    while True:
+        await asyncio.sleep(JOB_REAP_INTERVAL_SECONDS)
+        now = time.time()
+        unpaid_cutoff = now - UNPAID_JOB_RETENTION_SECONDS
+        running_cutoff = now - MAX_RUNNING_SECONDS
+        expired = [
+            job_id for job_id in JOBS_BY_STATUS["AWAITING_PAYMENT"]
+            if JOBS[job_id].created_at < unpaid_cutoff
+        ]
+        stalled = [
+            job_id for job_id in JOBS_BY_STATUS["RUNNING"]
+            if (JOBS[job_id].started_at or JOBS[job_id].created_at) < running_cutoff
+        ]
+
+        for job_id in expired:
+            drop_job(job_id)
+        if expired:
+            logger.info("Dropped %s unpaid jobs older than %s seconds", len(expired), UNPAID_JOB_RETENTION_SECONDS)
+
+        for job_id in stalled:
+            set_job_status(job_id, JOBS[job_id], "PENDING")
+            PENDING_QUEUE.put_nowait(job_id)
+            logger.warning("Task %s has been RUNNING for over %s seconds; re-queued", job_id, MAX_RUNNING_SECONDS)
+        if stalled:
+            LAST_JOB_QUEUED_AT = time.monotonic()
+
+def load_jobs():
+    """Restores jobs written by save_jobs and re-queues the ones still PENDING."""
+    try:
+        with open(JOBS_STATE_PATH, "rb") as f:
+            saved = msgspec.json.decode(f.read(), type=dict[str, Job])
+    except FileNotFoundError:
+        return
+    except (OSError, msgspec.DecodeError) as e:
+        logger.error("Could not restore jobs from %s: %s", JOBS_STATE_PATH, e)
+        return
+
+    for job_id, job in saved.items():
+        add_job(job_id, job)
+        if job.status == "PENDING":
+            PENDING_QUEUE.put_nowait(job_id)
+    logger.info("Restored %s unfinished jobs from %s", len(saved), JOBS_STATE_PATH)
 
 # --- Lifecycle events ---
 @app.on_event("startup")
 async def startup_event():
     """Runs on application startup"""
+    global HTTPX_CLIENT
+    load_jobs()
+    spawn_background_task(checkpoint_jobs())
+    spawn_background_task(reap_jobs())
+    HTTPX_CLIENT = httpx.AsyncClient(
+        http2=True,
+        timeout=30,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=30.0)
+    )
     await telegram_app.initialize()
-    webhook_url = f"{PUBLIC_SERVER_URL}/{BOT_TOKEN}"
-    logger.info(f"Setting Webhook to: {webhook_url}")
-    await telegram_app.bot.set_webhook(url=webhook_url)
+    webhook_url = f"{PUBLIC_SERVER_URL}{WEBHOOK_PATH}"
+    logger.info("Setting Webhook to: %s", webhook_url)
+    await BOT.set_webhook(url=webhook_url, secret_token=WEBHOOK_SECRET, max_connections=100)
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Runs on application shutdown"""
     logger.info("Removing Webhook and shutting down application...")
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    # Let a checkpoint that is already writing finish before the final save.
+    if CHECKPOINT_WRITE is not None:
+        try:
+            await CHECKPOINT_WRITE
+        except OSError:
+            pass  # Superseded by the final save below.
+    # Save before any network I/O, so a failing send cannot cost the snapshot.
+    try:
+        save_jobs()
+    except OSError as e:
+        logger.error("Could not save jobs to %s: %s", JOBS_STATE_PATH, e)
+    # Deliver notices still waiting for their coalescing window to close. Take
+    # them out first: a flush timer firing later then finds nothing.
+    pending = list(PENDING_NOTIFICATIONS.items())
+    PENDING_NOTIFICATIONS.clear()
+    for chat_id, lines in pending:
+        spawn_send_task(send_telegram_message(chat_id, "\n\n".join(lines)))
+    # Give sends already under way (e.g. "Payment successful") a bounded chance to finish.
+    if SEND_TASKS:
+        _, unfinished = await asyncio.wait(list(SEND_TASKS), timeout=SHUTDOWN_SEND_TIMEOUT_SECONDS)
+        if unfinished:
+            logger.warning("Dropping %s Telegram messages still unsent after %s seconds", len(unfinished), SHUTDOWN_SEND_TIMEOUT_SECONDS)
     await telegram_app.shutdown()
+    if HTTPX_CLIENT is not None:
+        await HTTPX_CLIENT.aclose()
+    # Flush any queued log records before the process exits.
+    LOG_LISTENER.stop()
@@ -2,19 +2,25 @@ import os
 import time
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import subprocess
+import re
 import shutil
+import zipfile
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 import threading
+import functools
 import ngrok
 import sys
+from collections import deque
 
 # ==============================================================================
 # --- 1. 基础设置 (Basic Setup) ---
 # ==============================================================================
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format='%(asctime)s - %(name)s - %(threadName)s - %(levelname)s - %(message)s',
     stream=sys.stdout
 )
 logger = logging.getLogger("LocalTextoonWorker")
@@ -26,6 +32,32 @@ logger = logging.getLogger("LocalTextoonWorker")
 # 您部署在云端的调度中心的公网IP地址
 DISPATCH_CENTER_URL = "http://34.87.45.115"
 
+# 取任务时的长轮询等待时间 (秒)。没有任务时调度中心会挂起请求，直到有新任务或超时，
+# 所以新任务几乎能立即被取到。请求超时必须比它长一些。
+GET_TASK_WAIT_SECONDS = 25
+
+# 同时处理的任务数 (槽位数)。每个槽位独立取任务、运行 Textoon 并上传结果。
+# 请根据显存大小调整，默认一次只跑一个任务。
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "1"))
+
+# 本地 HTTP 服务器 (端口 8082) 和 ngrok 隧道在第一次需要时启动，之后所有任务共用，
+# 直到 Worker 退出。锁保证只启动一次。
+NGROK_LOCK = threading.Lock()
+NGROK_LISTENER = None
+
+# 所有槽位共用一个 Session，复用到调度中心和 Telegram 的 keep-alive 连接，
+# 不用每次请求都重新握手。只有请求发出之前的连接失败会自动重试几次：
+# get-task 不是幂等的，请求已到达调度中心后再重发可能会多领走一个任务，
+# 所以读取失败和错误状态码都不重试，交给主循环处理。
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=2,
+    pool_maxsize=WORKER_CONCURRENCY,
+    max_retries=Retry(total=3, connect=3, read=0, status=0, other=0, backoff_factor=0.5)
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
 # 您为 Textoon 创建的 Conda 环境中的 Python 解释器路径
 # 例如: /home/your_user/miniconda3/envs/textoon/bin/python
 TEXTOON_PYTHON_PATH = "/home/deepseek/.conda/envs/textoon"
@@ -34,6 +66,24 @@ TEXTOON_PYTHON_PATH = "/home/deepseek/.conda/envs/textoon"
 # 例如: /home/your_user/projects/Textoon/main.py
 TEXTOON_SCRIPT_PATH = "/home/deepseek/textoon2/main.py"
 
+# 所有任务的输出目录和结果 zip 都放在这里。启动时按当前目录算一次绝对路径，
+# 之后不再依赖进程的当前工作目录。
+OUTPUT_DIR = os.path.abspath("output")
+# 结果 zip 单独放在这个目录里，ngrok 隧道只对外提供这个目录，
+# 不会暴露任务的原始输出目录。
+RESULTS_DIR = os.path.join(OUTPUT_DIR, "results")
+
+# Telegram Bot Token (与调度中心使用同一个机器人)，用于把结果文件直接发送给用户。
+# 运行前请先设置: export BOT_TOKEN='YOUR_BOT_TOKEN'
+# 未设置或文件超过 Telegram 的上传上限时，改用 ngrok 提供下载链接。
+TELEGRAM_BOT_TOKEN = os.environ.get("BOT_TOKEN")
+TELEGRAM_UPLOAD_LIMIT_BYTES = 50 * 1024 * 1024  # Bot API 上传文件的上限为 50 MB
+if not TELEGRAM_BOT_TOKEN:
+    logger.warning("BOT_TOKEN 环境变量未设置。结果文件将通过 ngrok 链接提供下载。")
+
+# Textoon 输出只在内存中保留最后这么多行，用于出错时记录日志
+TEXTOON_OUTPUT_TAIL_LINES = 500
+
 # ngrok authtoken, 强烈建议从环境变量加载
 # 运行前请先设置: export NGROK_AUTHTOKEN='YOUR_TOKEN'
 # 或者直接在这里填入: ngrok.set_auth_token("YOUR_TOKEN")
@@ -47,19 +97,69 @@ else:
 # --- 3. 核心功能 (Core Functions) ---
 # ==============================================================================
 
+def run_command_with_output_tail(command: list[str], timeout: float) -> str:
+    """
+    运行命令并逐行读取它的输出 (stdout 和 stderr 合并)，内存中只保留最后
+    TEXTOON_OUTPUT_TAIL_LINES 行。成功时返回这些行；失败或超时时抛出
+    CalledProcessError / TimeoutExpired，其 output 为这些行。
+    """
+    proc = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        # 输出里混有非 UTF-8 字节时替换掉，不能让读取线程因解码错误退出
+        encoding="utf-8",
+        errors="replace",
+        bufsize=1
+    )
+    output_tail = deque(maxlen=TEXTOON_OUTPUT_TAIL_LINES)
+    # 子进程的子进程可能一直占着 stdout，读取线程在 join 超时后仍会继续写入，
+    # 所以读写 output_tail 都要持锁
+    output_lock = threading.Lock()
+
+    def drain_output():
+        for line in proc.stdout:
+            with output_lock:
+                output_tail.append(line)
+
+    def output_text() -> str:
+        with output_lock:
+            return "".join(output_tail)
+
+    # 在单独的线程中读取输出，避免管道写满导致子进程阻塞
+    drain = threading.Thread(target=drain_output, daemon=True)
+    drain.start()
+
+    try:
+        returncode = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        drain.join(timeout=5)
+        raise subprocess.TimeoutExpired(command, timeout, output=output_text())
+
+    drain.join(timeout=5)
+    output = output_text()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, output=output)
+    return output
+
 def run_textoon_locally(job_id: str, prompt: str) -> str | None:
     """
     在本地安全地执行 Textoon 命令，并将结果打包成 zip 文件。
     成功则返回打包后的 zip 文件路径，失败则返回 None。
     """
-    base_output_dir = os.path.join(os.getcwd(), "output")
-    job_output_dir = os.path.join(base_output_dir, job_id)
-    zip_output_path = os.path.join(base_output_dir, f"{job_id}.zip")
+    job_output_dir = os.path.join(OUTPUT_DIR, job_id)
+    zip_output_path = os.path.join(RESULTS_DIR, f"{job_id}.zip")
 
-    # 清理旧文件并创建新目录
+    # 清理旧文件并创建新目录。旧目录 (例如任务被重新排队后再次运行) 可能有成千上万个文件，
+    # 先改名挪开，再在后台线程中删除，不耽误这次任务开始运行
     if os.path.exists(job_output_dir):
-        shutil.rmtree(job_output_dir)
+        stale_dir = f"{job_output_dir}.stale-{time.time_ns()}"
+        os.rename(job_output_dir, stale_dir)
+        threading.Thread(target=shutil.rmtree, args=(stale_dir,), kwargs={"ignore_errors": True}, daemon=True).start()
     os.makedirs(job_output_dir, exist_ok=True)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
 
     logger.info(f"Starting local task {job_id}. Output will be in: {job_output_dir}")
 
@@ -76,57 +176,91 @@ def run_textoon_locally(job_id: str, prompt: str) -> str | None:
         ]
         
         # 执行命令，设置较长的超时时间
-        result = subprocess.run(
-            command,
-            check=True,
-            capture_output=True,
-            text=True,
-            timeout=600  # 10分钟超时
-        )
+        output = run_command_with_output_tail(command, timeout=600)  # 10分钟超时
         logger.info(f"Textoon script for job {job_id} executed successfully.")
-        logger.debug(f"Script output:\n{result.stdout}")
+        logger.debug(f"Script output (last {TEXTOON_OUTPUT_TAIL_LINES} lines):\n{output}")
 
         # 将生成的结果目录打包成一个 zip 文件
+        # 结果大多是已经压缩过的图片和模型文件，再 DEFLATE 一遍只会白白消耗 CPU，所以只存储不压缩
         logger.info(f"Zipping output directory '{job_output_dir}' to '{zip_output_path}'")
-        shutil.make_archive(os.path.join(base_output_dir, job_id), 'zip', job_output_dir)
+        with zipfile.ZipFile(zip_output_path, 'w', zipfile.ZIP_STORED) as zf:
+            for root, _, files in os.walk(job_output_dir):
+                for name in files:
+                    path = os.path.join(root, name)
+                    zf.write(path, os.path.relpath(path, job_output_dir))
         
         return zip_output_path
 
-    except subprocess.TimeoutExpired:
-        logger.error(f"Task {job_id} timed out.")
+    except subprocess.TimeoutExpired as e:
+        logger.error(f"Task {job_id} timed out.\n--- OUTPUT (last {TEXTOON_OUTPUT_TAIL_LINES} lines) ---\n{e.output}")
         return None
     except subprocess.CalledProcessError as e:
-        logger.error(f"Textoon script failed for job {job_id}:\n--- STDERR ---\n{e.stderr}\n--- STDOUT ---\n{e.stdout}")
+        logger.error(f"Textoon script failed for job {job_id}:\n--- OUTPUT (last {TEXTOON_OUTPUT_TAIL_LINES} lines) ---\n{e.output}")
         return None
     except Exception as e:
         logger.error(f"An unexpected error occurred during local execution for job {job_id}: {e}")
         return None
 
-def serve_file_with_ngrok(file_path: str) -> str | None:
+def send_file_via_telegram(chat_id: int, job_id: str, file_path: str) -> bool:
     """
-    为一个文件启动一个临时的 Web 服务器和 ngrok 隧道，并返回公网 URL。
+    通过 Telegram Bot API (sendDocument) 把结果文件直接发送给用户。
+    成功返回 True，失败返回 False。
     """
-    if not os.path.exists(file_path):
-        logger.error(f"File not found for serving: {file_path}")
+    if not TELEGRAM_BOT_TOKEN or os.path.getsize(file_path) > TELEGRAM_UPLOAD_LIMIT_BYTES:
+        return False
+
+    logger.info(f"Uploading '{file_path}' to Telegram chat {chat_id}")
+    try:
+        with open(file_path, "rb") as f:
+            response = SESSION.post(
+                f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendDocument",
+                data={"chat_id": chat_id, "caption": f"Result of task {job_id}"},
+                files={"document": (os.path.basename(file_path), f, "application/zip")},
+                timeout=300
+            )
+    except requests.exceptions.RequestException as e:
+        # 异常信息里带有包含 Token 的 URL，只记录异常类型
+        logger.error(f"Failed to upload result of job {job_id} to Telegram: {type(e).__name__}")
+        return False
+
+    if not response.ok:
+        try:
+            description = response.json().get("description")
+        except ValueError:
+            description = response.status_code
+        logger.error(f"Telegram rejected the result of job {job_id}: {description}")
+        return False
+    return True
+
+# 只允许下载 /<job_id>.zip，job_id 为 32 位十六进制
+RESULT_PATH_PATTERN = re.compile(r"/[0-9a-f]{32}\.zip")
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass # 抑制日志输出
+
+    def send_head(self):
+        # 隧道对任何人开放，除了结果 zip 以外一律返回 404，也不提供目录列表，
+        # 拿到一个下载链接的人无法看到其他用户的结果
+        if not RESULT_PATH_PATTERN.fullmatch(self.path):
+            self.send_error(404, "File not found")
+            return None
+        return super().send_head()
+
+    def list_directory(self, path):
+        self.send_error(404, "File not found")
         return None
 
-    # ngrok 只能服务于一个目录，所以我们服务于文件所在的目录
-    directory = os.path.dirname(file_path)
-    filename = os.path.basename(file_path)
-    
-    # 在一个单独的线程中启动 HTTP 服务器
-    class QuietHandler(SimpleHTTPRequestHandler):
-        def log_message(self, format, *args):
-            pass # 抑制日志输出
-
-    httpd = HTTPServer(("localhost", 8082), QuietHandler)
-    
-    def serve():
-        # 切换到目标目录才能正确提供服务
-        os.chdir(directory)
-        httpd.serve_forever()
-
-    thread = threading.Thread(target=serve)
+def start_file_server(directory: str):
+    """
+    在后台线程中启动提供 directory 目录的 Web 服务器，并为它创建 ngrok 隧道。
+    返回 ngrok listener。
+    """
+    # 通过 directory 参数指定目录，不用 os.chdir 改变整个进程的当前目录
+    handler = functools.partial(QuietHandler, directory=directory)
+    httpd = HTTPServer(("localhost", 8082), handler)
+
+    thread = threading.Thread(target=httpd.serve_forever, name="file-server")
     thread.daemon = True
     thread.start()
     logger.info(f"Serving directory '{directory}' on http://localhost:8082")
@@ -134,40 +268,68 @@ def serve_file_with_ngrok(file_path: str) -> str | None:
     try:
         # 启动 ngrok 隧道
         listener = ngrok.connect(8082, "http")
-        public_url = listener.public_url
-        download_url = f"{public_url}/{filename}"
-        logger.info(f"ngrok tunnel created. Download URL: {download_url}")
-        return download_url
+    except Exception:
+        # 释放端口，下次需要时可以重新启动
+        httpd.shutdown()
+        httpd.server_close()
+        raise
+    logger.info(f"ngrok tunnel created: {listener.public_url}")
+    return listener
+
+def serve_file_with_ngrok(file_path: str) -> str | None:
+    """
+    返回一个文件的公网下载 URL。共用的 Web 服务器和 ngrok 隧道在第一次调用时启动。
+    """
+    global NGROK_LISTENER
+
+    if not os.path.exists(file_path):
+        logger.error(f"File not found for serving: {file_path}")
+        return None
+
+    # 所有结果 zip 都在 RESULTS_DIR 下，服务器只提供这个目录
+    filename = os.path.basename(file_path)
+
+    try:
+        with NGROK_LOCK:
+            if NGROK_LISTENER is None:
+                NGROK_LISTENER = start_file_server(RESULTS_DIR)
     except Exception as e:
         logger.error(f"Failed to create ngrok tunnel: {e}")
         return None
 
+    download_url = f"{NGROK_LISTENER.public_url}/{filename}"
+    logger.info(f"Download URL: {download_url}")
+    return download_url
+
 
 # ==============================================================================
 # --- 4. 主循环 (Main Loop) ---
 # ==============================================================================
 
-def main():
-    logger.info("======================================================")
-    logger.info("=== Local Textoon Worker for Telegram Bot is starting...")
-    logger.info("=== Prerequisite Check:")
-    logger.info("=== 1. Is ComfyUI with all custom nodes running?")
-    logger.info("=== 2. Are all .safetensors models in the correct folders?")
-    logger.info("=== 3. Are all paths in this script configured correctly?")
-    logger.info("======================================================")
-    
-    active_listener = None
+def report_task_status(job_id: str, status: str, result_url: str | None = None):
+    """向调度中心更新任务状态。"""
+    logger.info(f"Updating task {job_id} status to {status}")
+    SESSION.post(
+        f"{DISPATCH_CENTER_URL}/api/update-task",
+        json={
+            "job_id": job_id,
+            "status": status,
+            "result_url": result_url
+        },
+        timeout=30
+    )
 
+def worker_slot():
+    """一个槽位的主循环：取任务、执行、上传结果，然后继续取下一个任务。"""
     while True:
         try:
-            # 在开始新任务前，关闭旧的 ngrok 隧道
-            if active_listener:
-                logger.info("Closing previous ngrok tunnel...")
-                ngrok.disconnect(active_listener.public_url)
-                active_listener = None
-
             # 1. 从云端调度中心获取任务
-            response = requests.get(f"{DISPATCH_CENTER_URL}/api/get-task", timeout=15)
+            poll_started = time.monotonic()
+            response = SESSION.get(
+                f"{DISPATCH_CENTER_URL}/api/get-task",
+                params={"wait": GET_TASK_WAIT_SECONDS},
+                timeout=GET_TASK_WAIT_SECONDS + 10
+            )
             response.raise_for_status()
             task = response.json()
 
@@ -178,38 +340,25 @@ def main():
 
                 # 2. 本地执行画图并打包
                 zip_file_path = run_textoon_locally(job_id, prompt)
-                
-                status_to_update = "FAILED"
-                public_url = None
 
-                if zip_file_path:
-                    # 3. 为结果文件创建公网链接
+                if not zip_file_path:
+                    report_task_status(job_id, "FAILED")
+                elif send_file_via_telegram(task["chat_id"], job_id, zip_file_path):
+                    # 3. 结果已通过 Telegram 直接发给用户
+                    report_task_status(job_id, "COMPLETED")
+                else:
+                    # 3. 无法直接发送时，为结果文件创建公网链接。
+                    # 隧道一直开着，不需要等用户下载完，可以立即去取下一个任务
                     public_url = serve_file_with_ngrok(zip_file_path)
                     if public_url:
-                        status_to_update = "COMPLETED"
-                        # 保存 listener 以便下次循环时关闭
-                        active_listener = ngrok.get_listeners()[0] 
-                
-                # 4. 向调度中心更新任务状态
-                logger.info(f"Updating task {job_id} status to {status_to_update}")
-                requests.post(
-                    f"{DISPATCH_CENTER_URL}/api/update-task",
-                    json={
-                        "job_id": job_id,
-                        "status": status_to_update,
-                        "result_url": public_url
-                    },
-                    timeout=30
-                )
-                
-                # 如果任务成功，我们让隧道保持一段时间以便用户下载
-                if status_to_update == "COMPLETED":
-                    logger.info("Task completed. Keeping ngrok tunnel open for 10 minutes for download.")
-                    time.sleep(600)
-
-            else:
-                # 如果没有任务，等待
-                time.sleep(10)
+                        report_task_status(job_id, "COMPLETED", public_url)
+                    else:
+                        report_task_status(job_id, "FAILED")
+
+            elif time.monotonic() - poll_started < GET_TASK_WAIT_SECONDS:
+                # 调度中心没有挂起请求就返回了空结果 (例如不支持长轮询的旧版)，
+                # 按它建议的间隔等待 (不返回该字段时等待 10 秒)。长轮询超时则立即重新请求。
+                time.sleep(task.get("retry_after_ms", 10000) / 1000)
 
         except requests.exceptions.RequestException as e:
             logger.error(f"Could not connect to Dispatch Center: {e}. Retrying in 30 seconds.")
@@ -218,6 +367,33 @@ def main():
             logger.error(f"An unexpected error occurred in the main loop: {e}", exc_info=True)
             time.sleep(30)
 
+def main():
+    logger.info("======================================================")
+    logger.info("=== Local Textoon Worker for Telegram Bot is starting...")
+    logger.info("=== Prerequisite Check:")
+    logger.info("=== 1. Is ComfyUI with all custom nodes running?")
+    logger.info("=== 2. Are all .safetensors models in the correct folders?")
+    logger.info("=== 3. Are all paths in this script configured correctly?")
+    logger.info("======================================================")
+    logger.info(f"Running {WORKER_CONCURRENCY} worker slot(s).")
+
+    # 每个槽位一个线程。Textoon 在子进程中运行，线程只是等待它和网络 I/O。
+    slots = [
+        threading.Thread(target=worker_slot, name=f"slot-{i + 1}", daemon=True)
+        for i in range(WORKER_CONCURRENCY)
+    ]
+    for slot in slots:
+        slot.start()
+    try:
+        for slot in slots:
+            slot.join()
+    except KeyboardInterrupt:
+        logger.info("Worker is shutting down...")
+    finally:
+        # 共用的 ngrok 隧道只在退出时关闭一次
+        if NGROK_LISTENER is not None:
+            logger.info("Closing ngrok tunnel...")
+            ngrok.disconnect(NGROK_LISTENER.public_url)
+
 if __name__ == "__main__":
     main()
-